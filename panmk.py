@@ -1,16 +1,16 @@
 #!/usr/bin/env python3
 
-import argparse
-import asyncio
-import configparser
 import os
-import subprocess
+import re
 import sys
 
 from contextlib import suppress
-from platform import system as get_system
+from functools import lru_cache
 from time import sleep
 
+# Heavier modules (argparse, configparser, subprocess, ...) are imported where they
+# are used, so that start-up only pays for what a given run actually needs
+
 # Constants
 PROGRAM_NAME = 'PanMK'
 VERSION = '0.1a'
@@ -18,26 +18,85 @@ VERSION = '0.1a'
 # Number of seconds to wait between calling `terminate()` and `kill()`
 DEATH_DELAY = 5
 
+# Default number of seconds to wait between checks when polling for changes
+POLL_INTERVAL = 1.0
+
+# The user's home directory, which we only need to look up once
+HOME = os.path.expanduser('~')
+
+# What `platform.system()` calls the platforms it names exactly
+SYSTEMS = {'Windows': 'windows', 'Darwin': 'darwin', 'Linux': 'linux'}
+
+# Bump this whenever what `parse_config` returns for the same file changes,
+# so the rc cache doesn't hand back configs parsed the old way
+RC_CACHE_VERSION = 2
+
+# Number of seconds to wait for `pandoc server` to start accepting requests
+SERVER_STARTUP_DELAY = 5
+
+# Number of seconds `pandoc server` may spend on one compile, instead of its default of 2
+SERVER_TIMEOUT = 60
+
+# Formats `pandoc server` can write, keyed by output file extension
+# The server can't read any files, so these are only the text formats, which link to
+# images and the like rather than embedding them (as docx, odt and epub would)
+SERVER_WRITERS = {'html': 'html', 'htm': 'html', 'tex': 'latex', 'md': 'markdown', 'rst': 'rst'}
+
+# Formats `pandoc server` can read, keyed by input file extension
+# Only markdown, since the others can include files (\input, `.. include::`, `#+INCLUDE`),
+# which the server can't read; anything else goes through the command line
+SERVER_READERS = {'md': 'markdown', 'markdown': 'markdown'}
+
+# Matches the target of markdown images, as in `![caption](path "title")` or `![caption](<a path>)`
+IMAGE_RE = re.compile(rb'!\[[^\]]*\]\(\s*(?:<([^>]+)>|([^)\s]+))')
+
+# Matches markdown that makes pandoc read files we don't track: reference definitions
+# (as in `[ref]: image.png`), YAML metadata blocks (which can name a bibliography) and raw HTML images
+UNTRACKED_RE = re.compile(rb'^ {0,3}\[[^\]]+\]:|^---[ \t]*$|<img\b', re.MULTILINE | re.IGNORECASE)
+
+# Extensions of the sources we know how to find the inputs of
+MARKDOWN_EXTENSIONS = {'md', 'markdown'}
+
+# pandoc options whose value is a file that goes into the output
+FILE_OPTIONS = {'--template', '--css', '-c', '--bibliography', '--csl', '--citation-abbreviations',
+                '--include-in-header', '-H', '--include-before-body', '-B',
+                '--include-after-body', '-A', '--lua-filter', '-L', '--metadata-file',
+                '--reference-doc', '--abbreviations', '--syntax-definition',
+                '--epub-cover-image', '--epub-metadata', '--epub-embed-font'}
+
+# pandoc options that make pandoc read files we can't work out from the command line
+# (or make us unsure the source is markdown at all)
+UNKNOWN_INPUT_OPTIONS = {'--data-dir', '--resource-path', '--defaults', '-d', '--filter', '-F',
+                         '--citeproc', '-C', '--from', '-f', '--read', '-r'}
+
 def get_platform():
     ''' Guess the platform the user is using.
 
         Naturally, this will fail miserably if you invoke the Windows version from Cywgin/WSL.
     '''
 
+    from platform import system as get_system
+
+    system = get_system()
+    if system in SYSTEMS:
+        return SYSTEMS[system]
+
+    # Cygwin reports its version too, as in 'CYGWIN_NT-10.0'
+    if system.startswith('CYGWIN'):
+        return 'cygwin'
+
     # BSD needs its own case because I don't think SIGUSR1 will reload files...
-    platforms = ['windows', 'cygin', 'darwin', 'bsd']
-    platform = get_system().lower()
+    if 'BSD' in system:
+        return 'bsd'
 
-    for plat in platforms:
-        if plat in platform:
-            return plat
-    else:
-        # Assume that all other system are linux-like enough that this is fine
-        return 'linux'
+    # Assume that all other system are linux-like enough that this is fine
+    return 'linux'
 
 def get_cmd_args():
     '''Parses the command line arguments and returns them.'''
 
+    import argparse
+
     parser = argparse.ArgumentParser(prog='%s' % (PROGRAM_NAME.lower()),
                                      description='%s %s: Automatic pandoc compiler routine' % (PROGRAM_NAME, VERSION))
 
@@ -62,6 +121,9 @@ def get_cmd_args():
     viewer_flag.add_argument('--no-new-viewer', dest='new-viewer', action='store_false', default=False,
                              help='in -pvc mode, start a new viewer only if needed')
 
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='compile up to N documents at once')
+
     parser.add_argument('--norc', dest='norc', action='store_true',
                         help='omit automatic reading of system, user, and project rc files')
 
@@ -81,22 +143,147 @@ def get_cmd_args():
                         help='The name of the output file.'
                              '{filename} will automatically be replaced with the input file\'s base name.')
 
-    parser.add_argument('filename', help='the root filename of the document(s) to compile')
+    parser.add_argument('filenames', metavar='filename', nargs='+',
+                        help='the root filename of the document(s) to compile')
+
+    args, pandoc_args = parser.parse_known_args()
+
+    if len(args.filenames) > 1:
+        if args.action != 'p':
+            parser.error('-pv and -pvc require one and only one filename specified')
+        if args.cd:
+            parser.error('--cd can only be used with one filename')
+        if '{filename}' not in args.output:
+            parser.error('{filename} must be in the output name when compiling several documents')
+
+        # Documents with the same base name in different directories would write over each other
+        output_files = {}
+        for filename in args.filenames:
+            output_file = os.path.abspath(get_output_file(filename, args.output))
+            if output_file in output_files:
+                parser.error('%s and %s would both be compiled to %s'
+                             % (output_files[output_file], filename, output_file))
+            output_files[output_file] = filename
+
+    # Everything except plain compiling only ever deals with one file
+    args.filename = args.filenames[0]
+
+    return args, pandoc_args
+
+
+def warn(message):
+    '''Reports `message` on stderr, the way argparse reports its errors.'''
+    print('%s: %s' % (PROGRAM_NAME.lower(), message), file=sys.stderr)
+
+
+def to_bool(value):
+    '''Interprets `value` as a boolean, reading strings from an rc file the way configparser would.'''
 
-    return parser.parse_known_args()
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
 
 
 def normalize_path(path):
     '''Converts `path` to an absolute path, expanding all variables along the way.'''
+
+    # Most paths have nothing to expand, so don't bother scanning them for it
+    if '$' not in path and '%' not in path and not path.startswith('~'):
+        return os.path.abspath(path)
     return os.path.abspath(os.path.expanduser(os.path.expandvars(path)))
 
 
-def read_config(path):
-    ''' Reads the config specified by path.'''
+def get_cache_path():
+    '''Returns the path of the file parsed rc files are cached in.'''
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(HOME, '.cache')
+    return normalize_path(os.path.join(cache_home, 'panmk', 'rc.pkl'))
+
+
+@lru_cache(maxsize=None)
+def load_rc_cache():
+    ''' Loads the cache of parsed rc files.
+
+        The cache maps `(RC_CACHE_VERSION, paths, stats)` to the config parsed from those files,
+        where `stats` holds the `(mtime_ns, size)` of each of `paths`.
+        A missing or corrupt cache is treated as empty.
+    '''
+
+    import pickle
+
+    with suppress(Exception):
+        with open(get_cache_path(), 'rb') as f:
+            cache = pickle.load(f)
+        if isinstance(cache, dict):
+            return cache
+    return {}
+
+
+def save_rc_cache(cache):
+    ''' Writes the cache of parsed rc files back to disk.
+
+        Failing to write the cache is not fatal, we'll just parse again next time.
+    '''
+
+    import pickle
+
+    path = get_cache_path()
+    with suppress(OSError):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so concurrent runs never see half a cache
+        tmp = '%s.%d' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
 
-    parser = configparser.ConfigParser(delimiters=('=',), comment_prefixes=('#',))
-    parser.read(path)
-    return {k: dict(v) for k, v in parser.items()}
+
+def parse_config(paths):
+    ''' Parses the configs specified by paths into one config.
+
+        Later files take precedence over earlier ones.
+    '''
+
+    import configparser
+
+    parser = configparser.ConfigParser(delimiters=('=',), comment_prefixes=('#',), interpolation=None)
+    parser.read(paths)
+
+    # Going through the section proxies costs a function call per value,
+    # so read the parsed sections directly, and fill in the defaults ourselves
+    defaults = dict(parser.defaults())
+    config = {name: dict(defaults, **section) for name, section in parser._sections.items()}
+    config[parser.default_section] = defaults
+    return config
+
+
+def read_config(paths):
+    ''' Reads the configs specified by paths, skipping any that don't exist.
+
+        Parsed configs are cached by the files' timestamps and sizes,
+        so unchanged rc files are only parsed once.
+    '''
+
+    found = []
+    stats = []
+    for path in paths:
+        with suppress(OSError):
+            stats.append(stat_key(path))
+            found.append(path)
+
+    if not found:
+        return {}
+
+    found = tuple(found)
+    key = (RC_CACHE_VERSION, found, tuple(stats))
+    cache = load_rc_cache()
+    if key not in cache:
+        # Forget older versions of these files, and anything an older panmk cached
+        for old in [k for k in cache if not isinstance(k, tuple) or len(k) != 3
+                    or k[0] != RC_CACHE_VERSION or k[1] == found]:
+            del cache[old]
+        cache[key] = parse_config(found)
+        save_rc_cache(cache)
+    return cache[key]
 
 def load_rc(rc, conf):
     ''' Loads the rc file `rc` if it exists.
@@ -107,44 +294,334 @@ def load_rc(rc, conf):
     # Convert `rc` to an absolute path and expand all variables
     rc = normalize_path(rc)
 
-    if not os.path.isfile(rc):
-        return
+    conf.update(read_config([rc]))
 
-    config = read_config(rc)
 
-    conf.update(config)
-
-
-def load_default_rc(platform, conf):
-    '''Loads the default rc, based on what platform you are own.'''
+def get_default_rc_paths(platform):
+    '''Returns the absolute paths of the default rc files, based on what platform you are own.'''
 
     if platform == 'windows':
-        sysdrive = os.environ['systemdrive']
-
-        path = os.path.join(sysdrive, 'panmk', 'panmkrc')
-        load_rc(path, args)
+        # `os.path.join('C:', ...)` would be relative to the current directory on that drive
+        sysdrive = os.environ.get('systemdrive', 'C:') + os.sep
 
-        path = os.path.expanduser(os.path.join('~user', '.panmkrc'))
-        load_rc(path, conf)
+        paths = [os.path.join(sysdrive, 'panmk', 'panmkrc'),
+                 os.path.join(HOME, '.panmkrc')]
 
     else:
         # This won't work if you execute this using the Windows Python binary
-        paths = ['/opt/local/share/panmk', '/usr/local/share/panmk',
-                 '/usr/local/lib/panmk', '~']
+        paths = [os.path.join(path, '.panmk') for path in
+                 ['/opt/local/share/panmk', '/usr/local/share/panmk', '/usr/local/lib/panmk', HOME]]
 
-        for path in paths:
-            load_rc(os.path.join(path, '.panmk'), conf)
+    return tuple(normalize_path(path) for path in paths)
 
 
-def call_pandoc(path, output, args):
-    '''Call pandoc to compile `path`, with arguments `args`'''
+def load_default_rc(conf):
+    ''' Loads the default rc files.
+
+        They are all parsed together, with later files overriding earlier ones.
+    '''
+
+    # Only worked out here, so that --norc and --version don't pay for it
+    conf.update(read_config(get_default_rc_paths(PLATFORM)))
+
+
+def get_output_file(path, output):
+    '''Returns the name of the file `path` is compiled to, given the `output` template.'''
 
     basename = os.path.splitext(os.path.basename(path))[0]
-    output_file = output.format(filename=basename)
-    proc = subprocess.run(['pandoc', path, '-o', output_file] + args, capture_output=True)
-    if proc.stderr:
-        print('%s' % proc.stderr)
-    return output_file
+    return output.format(filename=basename)
+
+
+def hash_file(path, digest):
+    '''Feeds the contents of `path` to `digest`, returning the contents as a buffer.'''
+
+    import mmap
+
+    with open(path, 'rb') as f:
+        try:
+            contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return b''
+    digest.update(contents)
+    return contents
+
+
+def get_input_files(args):
+    ''' Returns the files the pandoc arguments `args` make pandoc read.
+
+        Returns None if we can't tell, in which case nothing should be skipped.
+    '''
+
+    files = []
+    args = iter(args)
+    for arg in args:
+        if arg.startswith('--') and '=' in arg:
+            option, value = arg.split('=', 1)
+        elif arg.startswith('-') and not arg.startswith('--') and arg[:2] in FILE_OPTIONS | UNKNOWN_INPUT_OPTIONS:
+            # Short options can have their value stuck to them, as in `-cstyle.css`
+            option, value = arg[:2], arg[2:] or next(args, None)
+        elif arg in FILE_OPTIONS | UNKNOWN_INPUT_OPTIONS:
+            option, value = arg, next(args, None)
+        else:
+            # Either another input, or the value of some other option
+            if not arg.startswith('-') and os.path.isfile(arg):
+                files.append(arg)
+            continue
+
+        if option in UNKNOWN_INPUT_OPTIONS:
+            return None
+        if option in FILE_OPTIONS:
+            # pandoc looks some of these up elsewhere when they aren't a file, as with templates
+            if value is None or not os.path.isfile(value):
+                return None
+            files.append(value)
+
+    return files
+
+
+def get_build_hash(path, args):
+    ''' Returns a hash of everything that goes into compiling `path` with arguments `args`.
+
+        This covers the source itself, the images it references, the files named in the
+        pandoc arguments, the arguments themselves and the pandoc binary.
+        Returns None if we can't tell what pandoc will read, since then nothing should be skipped.
+        That includes every source that isn't markdown.
+    '''
+
+    from hashlib import blake2b
+
+    if get_extension(path) not in MARKDOWN_EXTENSIONS:
+        return None
+
+    files = get_input_files(args)
+    if files is None:
+        return None
+
+    # A new pandoc may well produce something different
+    pandoc = find_program('pandoc')
+    try:
+        digest = blake2b(repr((args, pandoc, stat_key(pandoc))).encode())
+    except OSError:
+        return None
+
+    for name in files:
+        digest.update(os.fsencode(name))
+        hash_file(name, digest)
+
+    contents = hash_file(path, digest)
+    if UNTRACKED_RE.search(contents):
+        return None
+
+    # Like pandoc, look for images relative to the working directory
+    for image in sorted({bracketed or bare for bracketed, bare in IMAGE_RE.findall(contents)}):
+        digest.update(image)
+        with suppress(OSError):
+            hash_file(os.fsdecode(image), digest)
+
+    return digest.digest()
+
+
+def get_stamp_file(output_file):
+    '''Returns the file the build hash of `output_file` is kept in.'''
+    return '%s.panmk-stamp' % output_file
+
+
+def read_stamp(output_file):
+    '''Returns the build hash `output_file` was last compiled with, if any.'''
+
+    with suppress(OSError):
+        with open(get_stamp_file(output_file), 'rb') as f:
+            return f.read()
+
+
+def write_stamp(output_file, build_hash):
+    '''Records that `output_file` is up to date with `build_hash`.'''
+
+    with suppress(OSError):
+        with open(get_stamp_file(output_file), 'wb') as f:
+            f.write(build_hash)
+
+
+@lru_cache(maxsize=None)
+def find_program(name):
+    ''' Returns the absolute path of the program `name`, or just `name` if it isn't on the PATH.
+
+        Looking it up once means every call after the first skips the PATH search.
+    '''
+
+    import shutil
+
+    return shutil.which(name) or name
+
+
+def get_pandoc_cmd(path, output_file, args):
+    '''Returns the command that compiles `path` into `output_file`, with arguments `args`.'''
+    return [find_program('pandoc'), path, '-o', output_file] + args
+
+
+def call_pandoc(cmd, output_file, build_hash=None):
+    ''' Call pandoc to compile into `output_file`, using the command `cmd` from `get_pandoc_cmd`.
+
+        If `build_hash` is given, it is stamped on the output once pandoc succeeds.
+        Returns pandoc's return code.
+    '''
+
+    import subprocess
+
+    # Let pandoc's warnings go straight to our stderr instead of buffering them
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL)
+    if build_hash is not None and proc.returncode == 0:
+        write_stamp(output_file, build_hash)
+    return proc.returncode
+
+
+def make(path, output_file, args, cmd, force=False):
+    ''' Compile `path` like `call_pandoc`, unless nothing changed since it was last compiled.
+
+        Set `force` to compile regardless.
+        Returns pandoc's return code, or 0 if there was nothing to do.
+    '''
+
+    try:
+        build_hash = get_build_hash(path, args)
+    except OSError:
+        # Let pandoc report the unreadable input, we just don't know whether it changed
+        build_hash = None
+
+    if force or build_hash is None or not os.path.exists(output_file) or read_stamp(output_file) != build_hash:
+        return call_pandoc(cmd, output_file, build_hash)
+    return 0
+
+
+def make_all(paths, output, args, force=False, jobs=1):
+    ''' Compile each of `paths` like `make`, running up to `jobs` compiles at once.
+
+        `output` is the output file template, as given to `-o`.
+        Returns the return code of each compile, in the order of `paths`.
+    '''
+
+    builds = []
+    for path in paths:
+        output_file = get_output_file(path, output)
+        builds.append((path, output_file, args, get_pandoc_cmd(path, output_file, args), force))
+
+    if jobs <= 1 or len(builds) == 1:
+        return [make(*build) for build in builds]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Each compile spends its time waiting on pandoc, so threads are all we need
+    with ThreadPoolExecutor(max_workers=min(jobs, len(builds))) as pool:
+        return list(pool.map(lambda build: make(*build), builds))
+
+
+def get_extension(path):
+    '''Returns the extension of `path`, without the dot.'''
+    return os.path.splitext(path)[1][1:].lower()
+
+
+class PandocWorker:
+    ''' A long-lived `pandoc server`, so continuous mode only pays pandoc's start-up once.
+
+        The server only does plain conversions, so anything that needs pandoc's
+        full command line (filters, templates, ...) has to go through `call_pandoc`.
+    '''
+
+    def __init__(self, reader, writer):
+        import socket
+        import subprocess
+
+        self.reader = reader
+        self.writer = writer
+        self.ready = False
+
+        # Let the OS pick a free port for us
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+
+        self.proc = subprocess.Popen([find_program('pandoc'), 'server', '--port', str(self.port),
+                                      '--timeout', str(SERVER_TIMEOUT)],
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                     # pandoc before 3.0 complains about `--port`, and we fall back anyway
+                                     stderr=subprocess.DEVNULL)
+
+    @classmethod
+    def for_file(cls, path, output_file, pandoc_args):
+        ''' Returns a worker that can compile `path` into `output_file`.
+
+            Returns None if the conversion needs the command line instead.
+        '''
+
+        writer = SERVER_WRITERS.get(get_extension(output_file))
+        reader = SERVER_READERS.get(get_extension(path))
+        if pandoc_args or writer is None or reader is None:
+            return None
+
+        try:
+            return cls(reader, writer)
+        except OSError:
+            return None
+
+    def request(self, body):
+        ''' Sends `body` to the server, waiting for it to start up if needed.'''
+
+        import urllib.error
+        import urllib.request
+
+        request = urllib.request.Request('http://127.0.0.1:%d/' % self.port, data=body,
+                                         headers={'Content-Type': 'application/json',
+                                                  'Accept': 'application/json'})
+
+        # The server is on this machine, so never let http_proxy send the document anywhere else
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+        attempts = 1 if self.ready else int(SERVER_STARTUP_DELAY / 0.1)
+        for attempt in range(attempts):
+            try:
+                with opener.open(request) as response:
+                    self.ready = True
+                    return response.read()
+            except urllib.error.HTTPError:
+                raise
+            except urllib.error.URLError:
+                # Old versions of pandoc don't have a server, and will just exit
+                if attempt + 1 == attempts or self.proc.poll() is not None:
+                    raise
+                sleep(0.1)
+
+    def compile(self, text):
+        '''Converts `text`, returning the output as bytes.'''
+
+        import base64
+        import json
+
+        body = json.dumps({'text': text, 'from': self.reader, 'to': self.writer}).encode()
+        result = json.loads(self.request(body))
+
+        for message in result.get('messages', []):
+            print(message.get('message', message), file=sys.stderr)
+
+        if result.get('base64'):
+            return base64.b64decode(result['output'])
+        return result['output'].encode('utf-8')
+
+    def write(self, path, output_file):
+        '''Compiles `path` into `output_file`.'''
+
+        with open(path, encoding='utf-8') as f:
+            output = self.compile(f.read())
+        with open(output_file, 'wb') as f:
+            f.write(output)
+
+    def close(self):
+        '''Stops the server.'''
+
+        self.proc.terminate()
+        with suppress(Exception):
+            self.proc.wait(timeout=DEATH_DELAY)
+        self.proc.kill()
 
 
 def get_loader_cmd(platform):
@@ -154,30 +631,48 @@ def get_loader_cmd(platform):
        This should speed up the loading and reloading functions.
     '''
 
+    # Programs are only looked up when a viewer is actually opened, since most runs never do
     if platform == 'windows':
-        cmd = lambda x: ['start', x]
-    elif platform == 'cygin':
-        cmd = lambda x: ['cmd', '/c', 'start', x]
+        # `start` is built into cmd, and takes the first quoted argument as the window title
+        cmd = lambda x: [find_program('cmd'), '/c', 'start', '', x]
+    elif platform == 'cygwin':
+        cmd = lambda x: [find_program('cmd'), '/c', 'start', x]
     elif platform == 'darwin':
-        cmd = lambda x: ['open', x]
+        cmd = lambda x: [find_program('open'), x]
     else:
         # Please work please work please work
-        cmd = lambda x: ['xdg-open', x]
+        cmd = lambda x: [find_program('xdg-open'), x]
 
     return cmd
 
 
 def get_file_loader(platform):
-    '''Returns a function that opens files for viewing on the given platform.'''
+    ''' Returns a function that opens files for viewing on the given platform.
+
+        The viewer is started in the background, and the function returns its Popen object
+        without waiting for it, since some viewers stay in the foreground until they are closed.
+    '''
 
     cmd = get_loader_cmd(platform)
-    return lambda x: subprocess.run(cmd(x))
+
+    def load_file(path):
+        import subprocess
+
+        # Keep the viewer out of our process group, so that ^C doesn't take it down with us
+        if platform == 'windows':
+            detach = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+        else:
+            detach = {'start_new_session': True}
+
+        return subprocess.Popen(cmd(path), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, close_fds=True, **detach)
+
+    return load_file
 
 
 def get_reloadable(path, load_file):
     '''Returns a Popen object so it can be reloaded'''
-
-    return subprocess.Popen(load_file(path))
+    return load_file(path)
 
 # Following this are some built-in restart functions
 def do_nothing(proc):
@@ -201,6 +696,8 @@ def hard_restart(proc):
         You call this 'insanity', I call this 'not dealing with your shit'.
     '''
 
+    import subprocess
+
     # First, get the args we passed
     args = proc.args
     # Be nice
@@ -211,8 +708,13 @@ def hard_restart(proc):
     proc = subprocess.Popen(args)
 
 
-def run_command(command):
-    ''' Some viewers need a specific command to reload the file.'''
+def run_command(*command):
+    ''' Some viewers need a specific command to reload the file.
+
+        To use from .panmk, list the command and its arguments, as in `run_command:pkill,-HUP,mupdf`.
+    '''
+
+    import subprocess
 
     return lambda x: subprocess.run(command)
 
@@ -225,37 +727,221 @@ def get_file_reloader(platform):
     elif platform in ['darwin', 'bsd']:
         # Use SIGINFO on MACOS + BSD
         return send_signal(29)
-    elif platform in ['linux', 'cygin']:
+    elif platform in ['linux', 'cygwin']:
         # You can either send SIGHUP (1) or SIGUSR1 (10)
         return send_signal(1)
 
 
+# The platform will not change while we are running, so work out everything
+# that depends on it once, instead of branching on it every time
+PLATFORM = get_platform()
+LOAD_FN = get_file_loader(PLATFORM)
+RELOAD_FN = get_file_reloader(PLATFORM)
+
+
 def pre_reload_kill_proc(proc):
     ''' Deal with the fact that sometimes...your files get locked on Windows.'''
     proc.kill()    
 
-def continuous(platform, args, pandoc_args, load_file, pre_reload_file, reload_file):
-    ''' Continuous mode: continually compile the file until ^C is sent.'''
 
-    pre = None
-    output = call_pandoc(args['filename'], args['output'], pandoc_args)
-    proc = get_reloadable(output, load_file)
+# The functions that can be named in an rc file, as `name` or `name:arg1,arg2`
+# Each entry is called with those arguments as strings, converts them as it needs,
+# and returns the function to use
+REGISTRY = {
+    'do_nothing': lambda: do_nothing,
+    'hard_restart': lambda: hard_restart,
+    'kill_proc': lambda: pre_reload_kill_proc,
+    'run_command': run_command,
+    'send_signal': lambda signal: send_signal(int(signal)),
+}
+
+
+def parse_rc_function(value):
+    '''Looks up the function described by the rc value `value` in `REGISTRY`.'''
+
+    name, _, args = value.partition(':')
+    args = [arg.strip() for arg in args.split(',')] if args else []
+    return REGISTRY[name.strip()](*args)
+
+
+def get_rc_function(section, key, default):
+    ''' Returns the function named by `key` in the rc section `section`, or `default` if there isn't one.'''
+
+    value = section.get(key)
+    if not value:
+        return default
+
+    try:
+        return parse_rc_function(value)
+    except (KeyError, TypeError, ValueError) as e:
+        warn('ignoring invalid %s %r: %s' % (key, value, e))
+        return default
+
+def stat_key(path):
+    ''' Returns the parts of `path`'s stat that change when it is modified.
+
+        The access time is deliberately left out, since merely reading the file updates it.
+    '''
+
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+async def watch_file(path, poll_interval=POLL_INTERVAL):
+    ''' Yields every time `path` is modified.
+
+        Uses OS-level file events through `watchfiles` when it is installed,
+        and falls back to polling the file's timestamp every `poll_interval`
+        seconds when it is not.
+    '''
+
+    import asyncio
+
     try:
+        from watchfiles import Change, awatch
+    except ImportError:
+        # watchfiles is optional; without it we fall back to polling
+        awatch = None
+
+    # Some platforms (FSEvents, for one) report the canonical path, so compare against that
+    path = os.path.realpath(path)
+
+    if awatch is not None:
+        # Watch the directory rather than the file, since a lot of editors save
+        # by replacing the file, which would leave us watching a dead inode
+        # Don't watch what's below it, though, or a file in ~ would watch the whole home directory
+        watch_filter = lambda change, changed: change != Change.deleted and changed == path
+        async for changes in awatch(os.path.dirname(path), watch_filter=watch_filter, recursive=False):
+            yield changes
+    else:
+        pre = None
+        with suppress(OSError):
+            pre = stat_key(path)
         while True:
-            # TODO: optimize this slightly
-            cur = os.stat(args['filename'])
+            await asyncio.sleep(poll_interval)
+            try:
+                cur = stat_key(path)
+            except OSError:
+                # Some editors move the file aside before writing the new one
+                continue
             if cur != pre:
                 pre = cur
-                try:
-                    # Screw you, Adobe Reader
-                    pre_reload_file(proc)
-                    call_pandoc(args['filename'], args['output'], pandoc_args)
-                    reload_file(proc)
-                except KeyboardInterrupt:
-                    pass
-        sleep(1)
-    except KeyboardInterrupt:
-        pass
+                yield cur
+
+
+async def call_pandoc_async(cmd, output_file, build_hash=None):
+    ''' Like `call_pandoc`, but without blocking the event loop.
+
+        If the compile is cancelled, pandoc is killed.
+        Returns pandoc's return code.
+    '''
+
+    import asyncio
+
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
+    try:
+        returncode = await proc.wait()
+    except asyncio.CancelledError:
+        # Nobody wants the output of a stale compile
+        with suppress(ProcessLookupError):
+            proc.kill()
+        await proc.wait()
+        raise
+
+    if build_hash is not None and returncode == 0:
+        write_stamp(output_file, build_hash)
+    return returncode
+
+
+async def continuous(args, pandoc_args, output_file, pandoc_cmd,
+                     load_file, pre_reload_file, reload_file):
+    ''' Continuous mode: continually compile the file until ^C is sent.
+
+        Changes keep being watched while pandoc runs, and a change
+        in the middle of a compile cancels it and starts a new one.
+    '''
+
+    import asyncio
+
+    # Values from the rc file are strings
+    try:
+        poll_interval = float(args.get('poll_interval', POLL_INTERVAL))
+    except ValueError:
+        warn('ignoring invalid poll_interval %r' % args['poll_interval'])
+        poll_interval = POLL_INTERVAL
+
+    make(args['filename'], output_file, pandoc_args, pandoc_cmd, args['g'])
+    proc = get_reloadable(output_file, load_file)
+    last_hash = read_stamp(output_file)
+
+    # Keep pandoc running between compiles when we can
+    worker = PandocWorker.for_file(args['filename'], output_file, pandoc_args)
+
+    async def rebuild():
+        ''' Compile and reload once, reporting rather than raising any failure.
+
+            One bad compile or reload shouldn't end the whole session.
+        '''
+
+        try:
+            await compile_and_reload()
+        except Exception as e:
+            warn('rebuild failed: %s: %s' % (type(e).__name__, e))
+
+    async def compile_and_reload():
+        nonlocal last_hash, worker
+
+        # Saving without changing anything shouldn't cost us a compile
+        try:
+            build_hash = get_build_hash(args['filename'], pandoc_args)
+        except OSError:
+            # The editor may be halfway through saving; let pandoc deal with it
+            build_hash = None
+        if build_hash is not None and build_hash == last_hash:
+            return
+
+        # Screw you, Adobe Reader
+        pre_reload_file(proc)
+        returncode = None
+        if worker is not None:
+            # The server can't be interrupted, so let it finish even if we get cancelled
+            write = asyncio.ensure_future(asyncio.to_thread(worker.write, args['filename'], output_file))
+            try:
+                await asyncio.shield(write)
+                returncode = 0
+                if build_hash is not None:
+                    write_stamp(output_file, build_hash)
+            except asyncio.CancelledError:
+                with suppress(Exception):
+                    await write
+                raise
+            except (OSError, ValueError, KeyError):
+                # Give up on the server, and go back to running pandoc every time
+                worker.close()
+                worker = None
+        if worker is None:
+            returncode = await call_pandoc_async(pandoc_cmd, output_file, build_hash)
+        # Only a successful compile is up to date; after a failure, saving again should retry
+        if returncode == 0:
+            last_hash = build_hash
+        reload_file(proc)
+
+    build = None
+    try:
+        async for _ in watch_file(args['filename'], poll_interval):
+            # Whatever we were compiling is out of date now
+            if build is not None:
+                build.cancel()
+                with suppress(asyncio.CancelledError):
+                    await build
+            build = asyncio.create_task(rebuild())
+    finally:
+        if build is not None:
+            build.cancel()
+            with suppress(asyncio.CancelledError):
+                await build
+        if worker is not None:
+            worker.close()
 
 
 def main():
@@ -265,8 +951,6 @@ def main():
     args, pandoc_args = get_cmd_args()
     args = vars(args)
 
-    platform = get_platform()
-
     # Change directory if requested by the user
     # Do this before any of the user's code is executed
     if args.get('cd'):
@@ -277,19 +961,19 @@ def main():
         try:
             exec(args.exec)
         except Exception as e:
-            # TODO: use actual logging
-            print(e, file=sys.stderr)
+            warn(e)
 
     # Load the rc file
     conf = {}
     if args.get('rc'):
         load_rc(args.get('rc'), conf)
     elif not args.get('norc'):
-        load_default_rc(platform, conf)
+        load_default_rc(conf)
 
     # panmk mostly deals with the million ways to load and reload files
     # but there is also some config stuff in there we shouldn't overlook
     args.update(conf.get('args', {}))
+    args['g'] = to_bool(args['g'])
 
     # Get the file's extension
     ext = os.path.splitext(os.path.basename(args['output']))
@@ -303,43 +987,37 @@ def main():
     # There is a possibility that [re]loading a file is non-trivial
     # *COUGH* acroread *COUGH*
     # So we allow the user to specify a different [re]load function
-    if ext is not None:
-        # The configuration specifically defines how to open these files
-        if conf.get(ext):
-            # This is such a hack
-            try:
-                load_file = eval(conf[ext].get('load_file', 'None')) or get_file_loader(platform)
-            except Exception:
-                load_file = get_file_loader(platform)
-        else:
-            load_file = get_file_loader(platform)
+    # The configuration may specifically define how to open these files
+    section = conf.get(ext) or {}
+    load_file = get_rc_function(section, 'load_file', LOAD_FN)
 
     if args['new-viewer']:
         reload_file = load_file
         pre_reload_file = pre_reload_kill_proc
     else:
-        if conf.get(ext):
-            # This too, is such a hack
-            try:
-                reload_file = eval(conf[ext].get('reload_file', 'None')) or get_file_reloader(platform)
-            except Exception:
-                reload_file = get_file_reloader(platform)
-            try:
-                pre_reload_file = eval(conf[ext].get('pre_reload_file', 'None')) or (lambda x: None)
-            except Exception:
-                pre_reload_file = lambda x: None
-        else:
-            reload_file = get_file_reloader(platform)
-            pre_reload_file = lambda x: None
-
+        reload_file = get_rc_function(section, 'reload_file', RELOAD_FN)
+        pre_reload_file = get_rc_function(section, 'pre_reload_file', do_nothing)
 
     if args['action'] == 'p':
-        output = call_pandoc(args['filename'], args['output'], pandoc_args)
-    elif args['action'] == 'pv':
-        output = call_pandoc(args['filename'], args['output'], pandoc_args)
-        load_file(output)
+        # Values from the rc file are strings
+        returncodes = make_all(args['filenames'], args['output'], pandoc_args, args['g'], int(args['jobs']))
+        # Let whatever ran us (make, most likely) know that something failed
+        return 1 if any(returncodes) else 0
+
+    # Neither the output file nor the pandoc command change from one compile to the next
+    output_file = get_output_file(args['filename'], args['output'])
+    pandoc_cmd = get_pandoc_cmd(args['filename'], output_file, pandoc_args)
+
+    if args['action'] == 'pv':
+        if make(args['filename'], output_file, pandoc_args, pandoc_cmd, args['g']):
+            return 1
+        load_file(output_file)
     elif args['action'] == 'pvc':
-        continuous(platform, args, pandoc_args, load_file, pre_reload_file, reload_file)
+        import asyncio
+
+        with suppress(KeyboardInterrupt):
+            asyncio.run(continuous(args, pandoc_args, output_file, pandoc_cmd,
+                                   load_file, pre_reload_file, reload_file))
 
     return 0
 